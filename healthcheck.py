@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 import os
 import sys
-import psutil
+import tempfile
 
-# Check if the main.py process is running
-main_running = False
-for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-    if proc.info['cmdline'] and len(proc.info['cmdline']) > 1:
-        if 'python' in proc.info['cmdline'][0] and 'main.py' in proc.info['cmdline'][1]:
-            main_running = True
-            break
+pid_file = os.getenv('PID_FILE', os.path.join(tempfile.gettempdir(), 'bot.pid'))
 
-if main_running:
+# Check if the process that wrote the PID file is still running
+try:
+    with open(pid_file) as f:
+        pid = int(f.read().strip())
+    os.kill(pid, 0)
+except PermissionError:
+    # The process exists but belongs to another user
     sys.exit(0)
-else:
-    sys.exit(1)
\ No newline at end of file
+except (OSError, ValueError):
+    sys.exit(1)
+
+sys.exit(0)
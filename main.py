@@ -1,15 +1,26 @@
-from time import sleep
-from datetime import datetime, time, timedelta
+import asyncio
+import io
+import re
+from datetime import date, datetime, time, timedelta, timezone
 from dotenv import load_dotenv
 import os
 import logging
 import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from icalendar import Calendar
-from apscheduler.jobstores.base import JobLookupError
-from persistence import ensure_data_directory, save_user_reminders, load_user_reminders, load_all_users
-from functools import wraps
+from persistence import (
+    Reminder, format_event_id, parse_event_id, ensure_data_directory, save_user_reminders, save_all_reminders, update_reminders,
+    delete_reminders_before, load_user_reminders, load_all_users, close_connection,
+)
+from functools import partial, wraps
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,65 +32,84 @@ logger = logging.getLogger(__name__)
 # Dictionary to store user reminders
 user_reminders = {}
 
+# (user_id, event_id) pairs whose reminder changed since the last flush to disk
+dirty_reminders: set[tuple[int, int]] = set()
+
+# All database calls run on this single thread, off the event loop and in the order they were made
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
 # Get current working directory
 work_dir = os.getcwd(); 
 
 # Set up data directory
 data_path = os.getenv("DATA_PATH", os.path.join(work_dir, 'data'))
 
+# PID file read by healthcheck.py
+pid_file = os.getenv('PID_FILE', os.path.join(tempfile.gettempdir(), 'bot.pid'))
+
 # Load reminder timing configuration
 reminder_hour = int(os.getenv('REMINDER_HOUR', '17'))  # Default 5 PM
 reminder_minute = int(os.getenv('REMINDER_MINUTE', '0'))  # Default 0 minutes
 reminder_interval_hours = int(os.getenv('REMINDER_INTERVAL_HOURS', '2'))  # Default 2 hours
+reminder_time_of_day = time(reminder_hour, reminder_minute)
 logger.info(f"Configured reminder time: {reminder_hour}:{reminder_minute:02d}, interval: {reminder_interval_hours} hours")
 
+# How often the reminder sweep checks for due reminders, and how often
+# the schedule changes it makes are written to disk
+sweep_interval = timedelta(minutes=1)
+flush_interval = timedelta(minutes=1)
+
 # Parse whitelist users from environment
-whitelist_users = []
+whitelist_users = frozenset()
 whitelist_env = os.getenv('WHITELIST_USERS', '')
 if whitelist_env:
     try:
-        whitelist_users = [int(user_id.strip()) for user_id in whitelist_env.split(',') if user_id.strip()]
+        whitelist_users = frozenset(int(user_id.strip()) for user_id in whitelist_env.split(',') if user_id.strip())
         logger.info(f"Loaded {len(whitelist_users)} whitelisted users")
     except ValueError as e:
         logger.error(f"Error parsing WHITELIST_USERS: {e}")
 
 # Parse ignored terms from environment
-ignored_terms = []
+ignored_terms = ()
 ignored_terms_env = os.getenv('IGNORED_TERMS', 'Wertstoffhof geschlossen')
 if ignored_terms_env:
-    ignored_terms = [term.strip() for term in ignored_terms_env.split('||') if term.strip()]
+    ignored_terms = tuple(term.strip() for term in ignored_terms_env.split('||') if term.strip())
     logger.info(f"Loaded {len(ignored_terms)} ignored terms: {ignored_terms}")
 
-def _now_like(reference: datetime) -> datetime:
-    if isinstance(reference, datetime) and reference.tzinfo is not None:
-        return datetime.now(tz=reference.tzinfo)
-    return datetime.now()
-
-def _event_cutoff(event_start: datetime) -> datetime:
-    event_date = event_start.date()
-    tzinfo = event_start.tzinfo
-    # Reminder window ends at the day rollover into the event day (00:00).
-    return datetime.combine(event_date, time.min, tzinfo=tzinfo) if tzinfo else datetime.combine(event_date, time.min)
-
-def _is_event_expired(event_start: datetime, now: datetime | None = None) -> bool:
-    now = now or _now_like(event_start)
-    return now >= _event_cutoff(event_start)
-
-def _safe_schedule_removal(job, *, user_id: int | None = None, event_id: str | None = None) -> None:
-    if not job:
-        return
-    try:
-        job.schedule_removal()
-    except JobLookupError:
-        logger.debug(f"Job already removed (user={user_id}, event={event_id})")
-    except Exception as e:
-        logger.warning(f"Could not remove job (user={user_id}, event={event_id}): {e}")
-
-def _make_event_id(user_id: int, component, start_time: datetime, summary: str) -> str:
+# Match all ignored terms in a single pass, with pyahocorasick if available
+# and a precompiled regex alternation otherwise
+ignored_automaton = None
+ignored_pattern = None
+if ignored_terms and ahocorasick is not None:
+    ignored_automaton = ahocorasick.Automaton()
+    for term in ignored_terms:
+        ignored_automaton.add_word(term, term)
+    ignored_automaton.make_automaton()
+elif ignored_terms:
+    ignored_pattern = re.compile('|'.join(map(re.escape, ignored_terms)))
+
+_ICS_HEADER = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+_ICS_FOOTER = b"END:VCALENDAR\r\n"
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+_ONE_DAY = timedelta(days=1)
+
+# Due reminders of a user are sent together, split so messages stay well within Telegram's limits
+_MAX_REMINDERS_PER_MESSAGE = 20
+_MAX_BATCH_SUMMARY = 40
+_MAX_SUMMARY = 1000
+
+def _day_before_reminder(event_start: datetime) -> datetime:
+    # First reminder: the day before the event at the configured time.
+    return datetime.combine(event_start.date() - _ONE_DAY, reminder_time_of_day, tzinfo=event_start.tzinfo)
+
+def _make_event_id(user_id: int, component, start_time: datetime, summary: str) -> int:
     uid = str(component.get('uid', '')).strip()
     base = f"{user_id}|{uid}|{start_time.isoformat()}|{summary}"
-    digest = hashlib.md5(base.encode("utf-8", errors="ignore")).hexdigest()[:16]
-    return f"{user_id}_{digest}"
+    # 64 bit int keys are smaller and faster to hash than hex strings, they are
+    # only formatted as hex for storage and callback data
+    digest = hashlib.blake2b(base.encode("utf-8", errors="ignore"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
 
 def _format_event_when(event_start: datetime) -> str:
     if (
@@ -91,56 +121,239 @@ def _format_event_when(event_start: datetime) -> str:
         return event_start.strftime("%Y-%m-%d")
     return event_start.strftime("%Y-%m-%d %H:%M")
 
-def _start_time_sort_key(event_data: dict) -> float:
-    when = event_data.get("start_time")
-    if isinstance(when, datetime):
-        try:
-            return when.timestamp()
-        except Exception:
-            return float("inf")
-    return float("inf")
+def _start_time_sort_key(event_data: Reminder) -> float:
+    try:
+        return event_data.start_time.timestamp()
+    except Exception:
+        return float("inf")
 
-def _extract_event_type(summary: str, categories) -> str:
-    candidates: list[str] = []
-    if categories:
-        if isinstance(categories, (list, tuple, set)):
-            candidates = [str(c).strip() for c in categories if str(c).strip()]
-        elif hasattr(categories, "cats"):
-            try:
-                candidates = [str(c).strip() for c in categories.cats if str(c).strip()]
-            except Exception:
-                candidates = []
-        if not candidates:
-            candidates = [p.strip() for p in str(categories).split(",") if p.strip()]
+def _iter_categories(categories):
+    """Yield the non-empty category names of an event's CATEGORIES value.
 
-    if candidates:
-        return candidates[0]
+    icalendar gives a single vCategory for one CATEGORIES line and a list of them
+    for several, neither of which str() turns into the category names.
+    """
+    if not categories:
+        return
+    if hasattr(categories, "cats"):
+        items = categories.cats
+    elif isinstance(categories, (list, tuple, set)):
+        # Several CATEGORIES lines, each parsed into its own vCategory
+        items = (category for item in categories for category in (getattr(item, "cats", None) or (item,)))
+    else:
+        items = str(categories).split(",")
+    for category in items:
+        category = str(category).strip()
+        if category:
+            yield category
 
+def _extract_event_type(summary: str, categories) -> str:
+    # Return the first non-empty category without building the full list
+    for category in _iter_categories(categories):
+        return category
     return summary.strip() or "Unknown"
 
-def _prune_user_reminders(user_id: int, *, save: bool = False) -> int:
-    if user_id not in user_reminders or not user_reminders[user_id]:
-        return 0
-
-    removed = 0
-    for event_id in list(user_reminders[user_id].keys()):
-        event_data = user_reminders[user_id].get(event_id)
-        if not event_data:
+def _match_ignored_term(*texts: str) -> str | None:
+    """Return the first ignored term found in any of the texts, or None."""
+    if ignored_automaton is not None:
+        for text in texts:
+            for _, term in ignored_automaton.iter(text):
+                return term
+        return None
+
+    if ignored_pattern is not None:
+        for text in texts:
+            match = ignored_pattern.search(text)
+            if match:
+                return match.group(0)
+    return None
+
+def _is_raw_event_skipped(block: list[bytes], min_date: date) -> bool:
+    """Decide from the raw lines of a VEVENT whether it can be dropped unparsed.
+
+    Only returns True for events the full parse would skip as well: DTSTART before
+    min_date, or an ignored term in SUMMARY or CATEGORIES. Anything that cannot be
+    read cheaply (e.g. folded lines) is left to the full parse.
+    """
+    for line in block:
+        name = line[:10].upper()
+        if name.startswith(b"DTSTART") and line[7:8] in (b";", b":"):
+            value = line.rstrip().rpartition(b":")[2]
+            if len(value) >= 8 and value[:8].isdigit():
+                try:
+                    if date(int(value[:4]), int(value[4:6]), int(value[6:8])) < min_date:
+                        return True
+                except ValueError:
+                    pass
+        elif (name.startswith(b"SUMMARY") and line[7:8] in (b";", b":")) or (name == b"CATEGORIES" and line[10:11] in (b";", b":")):
+            value = line.partition(b":")[2].decode("utf-8", errors="replace").strip()
+            term = _match_ignored_term(value)
+            if term is not None:
+                logger.info(f"Ignoring event matching term '{term}': {value}")
+                return True
+    return False
+
+def _open_ics(content: bytes) -> io.BytesIO:
+    f = io.BytesIO(content)
+    # Some calendar exports start with a UTF-8 byte order mark
+    if content.startswith(_UTF8_BOM):
+        f.seek(len(_UTF8_BOM))
+    return f
+
+def _check_ics_calendar(content: bytes) -> None:
+    """Check that an ICS calendar is complete and register its VTIMEZONEs.
+
+    Events are parsed one by one afterwards, so a truncated file has to be rejected
+    up front rather than silently losing its last events. Registering every
+    VTIMEZONE with icalendar first lets TZID references resolve wherever the
+    timezone is defined in the file.
+    """
+    timezones: list[bytes] = []
+    in_event = in_timezone = seen_begin = seen_end = False
+
+    with _open_ics(content) as f:
+        for line in f:
+            marker = line.rstrip().upper()
+
+            if in_event:
+                if marker == b"END:VEVENT":
+                    in_event = False
+            elif in_timezone:
+                timezones.append(line)
+                if marker == b"END:VTIMEZONE":
+                    in_timezone = False
+            elif marker == b"BEGIN:VEVENT":
+                in_event = True
+            elif marker == b"BEGIN:VTIMEZONE":
+                in_timezone = True
+                timezones.append(line)
+            elif marker == b"BEGIN:VCALENDAR":
+                seen_begin = True
+            elif marker == b"END:VCALENDAR":
+                seen_end = True
+
+    if not seen_begin:
+        raise ValueError("File is not an iCalendar (missing BEGIN:VCALENDAR)")
+    if in_event or in_timezone or not seen_end:
+        raise ValueError("Calendar file is incomplete (missing END:VCALENDAR)")
+
+    if timezones:
+        Calendar.from_ical(_ICS_HEADER + b"".join(timezones) + _ICS_FOOTER)
+
+def _iter_ics_events(content: bytes, min_date: date | None = None):
+    """Yield the VEVENTs of an ICS calendar one at a time.
+
+    Each BEGIN:VEVENT ... END:VEVENT block is parsed on its own, so only a single
+    event is materialized at any time. The calendar is checked and its VTIMEZONEs
+    are registered before the first event is yielded. If min_date is given, blocks
+    that would be skipped anyway are dropped without being parsed.
+    """
+    _check_ics_calendar(content)
+
+    buf: list[bytes] = []
+    in_event = False
+
+    with _open_ics(content) as f:
+        for line in f:
+            if in_event:
+                buf.append(line)
+                if line.rstrip().upper() == b"END:VEVENT":
+                    in_event = False
+                    if min_date is not None and _is_raw_event_skipped(buf, min_date):
+                        buf = []
+                        continue
+                    cal = Calendar.from_ical(_ICS_HEADER + b"".join(buf) + _ICS_FOOTER)
+                    buf = []
+                    # The event is a direct child of the wrapper, no need to walk its alarms
+                    for component in cal.subcomponents:
+                        if component.name == "VEVENT":
+                            yield component
+            elif line.rstrip().upper() == b"BEGIN:VEVENT":
+                in_event = True
+                buf = [line]
+
+def _parse_ics_file(content: bytes, user_id: int) -> dict[int, Reminder]:
+    """Parse ICS content into new reminders, skipping ignored and expired events.
+
+    Runs in a worker thread, so it must not touch user_reminders or the job queue.
+    """
+    new_reminders: dict[int, Reminder] = {}
+
+    # The current time is bound once per upload, aware events convert it to their timezone
+    now_naive = datetime.now()
+    now_utc = datetime.now(timezone.utc)
+
+    # An event dated before today is expired in any timezone it can be in
+    # (the reminder window closes at 00:00 of the event day), skip those unparsed
+    for component in _iter_ics_events(content, min_date=now_naive.date()):
+        summary = str(component.get('summary', 'No Title'))
+        categories_value = component.get('categories', '')
+        # Match the category names as the raw line filter sees them, not the vCategory repr
+        categories = ",".join(_iter_categories(categories_value))
+
+        # Skip events based on ignored terms
+        term = _match_ignored_term(summary, categories)
+        if term is not None:
+            logger.info(f"Ignoring event matching term '{term}': {summary}")
+            continue  # Skip this event and continue with the next one
+
+        event_type = _extract_event_type(summary, categories_value)
+
+        dtstart = component.get('dtstart')
+        if not dtstart:
+            logger.warning(f"Skipping event without dtstart: {summary}")
             continue
 
-        event_start = event_data.get("start_time")
-        if not isinstance(event_start, datetime):
+        start_time = dtstart.dt
+
+        # Convert to datetime if it's a date
+        if not isinstance(start_time, datetime):
+            start_time = datetime.combine(start_time, time.min)
+
+        reminder = Reminder(summary=summary, start_time=start_time, event_type=event_type)
+
+        now = now_utc.astimezone(start_time.tzinfo) if start_time.tzinfo else now_naive
+        if now >= reminder.cutoff:
+            # Old calendars are mostly expired events, only format this when it will be shown
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Skipping expired event: {summary} at {start_time.isoformat()}")
             continue
 
-        now = _now_like(event_start)
-        if event_data.get("acknowledged", False) or _is_event_expired(event_start, now):
-            _safe_schedule_removal(event_data.get("job"), user_id=user_id, event_id=event_id)
-            user_reminders[user_id].pop(event_id, None)
-            removed += 1
+        event_id = _make_event_id(user_id, component, start_time, summary)
+
+        # Schedule the first reminder (day before at configured time)
+        reminder_time = _day_before_reminder(start_time)
+        reminder.next_reminder_time = reminder_time if reminder_time > now else now
+
+        new_reminders[event_id] = reminder
+
+    return new_reminders
 
-    if removed and save:
-        save_user_reminders(data_path, user_id, user_reminders[user_id])
+async def _run_db(func, *args, **kwargs):
+    """Run a persistence call on the database thread."""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(func, *args, **kwargs))
 
+def _prune_user_reminders(user_id: int) -> list[int]:
+    user_map = user_reminders.get(user_id)
+    if not user_map:
+        return []
+
+    now_naive = datetime.now()
+    now_utc = datetime.now(timezone.utc)
+
+    # Build the surviving reminders in one pass instead of popping from a copy of the keys
+    survivors: dict[int, Reminder] = {}
+    removed: list[int] = []
+    for event_id, event_data in user_map.items():
+        event_start = event_data.start_time
+        now = now_utc.astimezone(event_start.tzinfo) if event_start.tzinfo else now_naive
+        if event_data.acknowledged or now >= event_data.cutoff:
+            removed.append(event_id)
+        else:
+            survivors[event_id] = event_data
+
+    if removed:
+        user_reminders[user_id] = survivors
     return removed
 
 def whitelist_only(func):
@@ -191,15 +404,18 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """List all upcoming reminders for the user."""
     user_id = update.effective_user.id
 
-    _prune_user_reminders(user_id, save=True)
+    removed = _prune_user_reminders(user_id)
+    if removed:
+        await _run_db(update_reminders, data_path, deletions=[(user_id, event_id) for event_id in removed])
 
-    if user_id not in user_reminders or not user_reminders[user_id]:
+    user_map = user_reminders.get(user_id)
+    if not user_map:
         await update.message.reply_text("You don't have any active reminders.")
         return
 
-    grouped: dict[str, list[tuple[str, dict]]] = {}
-    for event_id, event_data in user_reminders[user_id].items():
-        event_type = event_data.get("event_type") or event_data.get("summary") or "Unknown"
+    grouped: dict[str, list[tuple[int, Reminder]]] = {}
+    for event_id, event_data in user_map.items():
+        event_type = event_data.event_type or event_data.summary or "Unknown"
         grouped.setdefault(event_type, []).append((event_id, event_data))
 
     for event_type, items in grouped.items():
@@ -209,13 +425,11 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     lines: list[str] = ["Your upcoming reminders (sorted by type):", ""]
     for event_type, items in groups_sorted:
-        next_when = items[0][1].get("start_time")
-        next_when_str = _format_event_when(next_when) if isinstance(next_when, datetime) else "?"
+        next_when = items[0][1].start_time
+        next_when_str = _format_event_when(next_when)
         lines.append(f"{event_type} — next: {next_when_str} ({len(items)})")
         for _, event_data in items:
-            when = event_data.get("start_time")
-            if isinstance(when, datetime):
-                lines.append(f"• {_format_event_when(when)}")
+            lines.append(f"• {_format_event_when(event_data.start_time)}")
         lines.append("")
 
     await update.message.reply_text("\n".join(lines).rstrip())
@@ -226,15 +440,11 @@ async def clear_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
 
     if user_id in user_reminders:
-        # Cancel all scheduled jobs
-        for event_id, event_data in user_reminders[user_id].items():
-            _safe_schedule_removal(event_data.get("job"), user_id=user_id, event_id=event_id)
-
         # Clear the reminders
         user_reminders[user_id] = {}
         
         # Save the empty reminders to disk
-        save_user_reminders(data_path, user_id, user_reminders[user_id])
+        await _run_db(save_user_reminders, data_path, user_id, {})
 
         await update.message.reply_text("All your reminders have been cleared.")
     else:
@@ -247,191 +457,188 @@ async def handle_ics_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if user_id not in user_reminders:
         user_reminders[user_id] = {}
+        pruned_ids = []
     else:
-        _prune_user_reminders(user_id, save=True)
+        # No save here, the deletions are saved together with the uploaded calendar below
+        pruned_ids = _prune_user_reminders(user_id)
 
     # Get the file
     file = await context.bot.get_file(update.message.document.file_id)
 
-    # Download the file
-    file_path = os.path.join(data_path, f"calendar_{user_id}.ics")
-    logger.info(f"Downloading calendar file for user {user_id} to: {file_path}")
+    # Download the file straight into memory, it is never written to disk
+    logger.info(f"Downloading calendar file for user {user_id}")
     try:
-        downloaded_path = await file.download_to_drive(file_path)
-        if not downloaded_path or not os.path.exists(downloaded_path):
-            raise FileNotFoundError(f"Failed to download file to {file_path}")
-        logger.info(f"File successfully downloaded to: {downloaded_path}")
+        content = bytes(await file.download_as_bytearray())
+        logger.info(f"Calendar file downloaded ({len(content)} bytes)")
     except Exception:
         logger.exception("Error downloading calendar file")
         await update.message.reply_text("Failed to download your calendar file. Please try again.")
         return
 
     try:
-        # Parse the ICS file
-        with open(file_path, 'rb') as f:
-            cal_content = f.read()
-            cal = Calendar.from_ical(cal_content)
-
-        # Process events
-        events_count = 0
-        new_reminders: dict[str, dict] = {}
-        
-        for component in cal.walk():
-            if component.name == "VEVENT":
-                summary = str(component.get('summary', 'No Title'))
-                categories_value = component.get('categories', '')
-                categories = str(categories_value or '')
-
-                # Skip events based on ignored terms
-                should_ignore = False
-                for term in ignored_terms:
-                    if term in summary or term in categories:
-                        should_ignore = True
-                        logger.info(f"Ignoring event matching term '{term}': {summary}")
-                        break
-                
-                if should_ignore:
-                    continue  # Skip this event and continue with the next one
+        # Parse the calendar off the event loop
+        new_reminders = await asyncio.to_thread(_parse_ics_file, content, user_id)
+        events_count = len(new_reminders)
+
+        # Events that were already known keep their reminder progress, so re-uploading
+        # the same calendar does not restart reminders that were already sent
+        old_reminders = user_reminders[user_id]
+        kept_ids = new_reminders.keys() & old_reminders.keys()
+        for event_id in kept_ids:
+            old_data = old_reminders[event_id]
+            if old_data.next_reminder_time is not None:
+                new_reminders[event_id].next_reminder_time = old_data.next_reminder_time
 
-                event_type = _extract_event_type(summary, categories_value)
+        # Replace existing reminders only after successfully parsing the calendar
+        logger.info(
+            f"Updating reminders for user {user_id}: {events_count - len(kept_ids)} added, "
+            f"{len(old_reminders) - len(kept_ids)} removed, {len(kept_ids)} unchanged"
+        )
+        user_reminders[user_id] = new_reminders
 
-                dtstart = component.get('dtstart')
-                if not dtstart:
-                    logger.warning(f"Skipping event without dtstart: {summary}")
-                    continue
+        # Save only the differences to disk, in a single transaction
+        await _run_db(
+            update_reminders,
+            data_path,
+            upserts=[
+                (user_id, event_id, event_data)
+                for event_id, event_data in new_reminders.items()
+                if old_reminders.get(event_id) != event_data
+            ],
+            deletions=[(user_id, event_id) for event_id in pruned_ids]
+            + [(user_id, event_id) for event_id in old_reminders.keys() - new_reminders.keys()],
+        )
 
-                start_time = dtstart.dt
+        # Send reminders that are already due without waiting for the next sweep
+        context.job_queue.run_once(sweep_reminders, 5)
+        
+        await update.message.reply_text(f"Calendar processed successfully! Set up {events_count} reminders.")
 
-                # Convert to datetime if it's a date
-                if not isinstance(start_time, datetime):
-                    start_time = datetime.combine(start_time, time.min)
+    except Exception as e:
+        logger.exception("Error processing ICS file")
+        await update.message.reply_text(f"Error processing your calendar file: {str(e)}")
 
-                now = _now_like(start_time)
-                if _is_event_expired(start_time, now):
-                    logger.info(f"Skipping expired event: {summary} at {start_time.isoformat()}")
-                    continue
+def _reminder_when(event_start: datetime, now: datetime) -> str:
+    """Describe when an event takes place relative to now, e.g. "for tomorrow (2024-05-01)"."""
+    event_date_str = event_start.strftime('%Y-%m-%d')
+    days_until = (event_start.date() - now.date()).days
+    if days_until == 1:
+        return f"scheduled for tomorrow ({event_date_str})"
+    if days_until == 0:
+        return f"scheduled for today ({event_date_str})"
+    return f"coming up on {event_date_str}"
+
+def _shorten(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def _build_reminder_message(due: list[tuple[int, Reminder, datetime]]) -> tuple[str, InlineKeyboardMarkup]:
+    """Build the text and acknowledge buttons of a reminder message for one or more events."""
+    if len(due) == 1:
+        event_id, event_data, now = due[0]
+        event_start = event_data.start_time
+        summary = _shorten(event_data.summary, _MAX_SUMMARY)
+        when = _reminder_when(event_start, now)
+        if (event_start.date() - now.date()).days == 1:
+            message = f"⚠️ REMINDER: You have '{summary}' {when}."
+        else:
+            message = f"⚠️ REMINDER: Don't forget about '{summary}' {when}."
+        keyboard = [[InlineKeyboardButton("Acknowledge", callback_data=f"ack_{format_event_id(event_id)}")]]
+    else:
+        # Summaries are shortened so a full batch stays within Telegram's message length limit
+        lines = [f"⚠️ REMINDER: Don't forget about these {len(due)} events:"]
+        keyboard = []
+        for event_id, event_data, now in due:
+            summary = _shorten(event_data.summary, _MAX_BATCH_SUMMARY)
+            lines.append(f"• '{summary}' {_reminder_when(event_data.start_time, now)}")
+            keyboard.append([InlineKeyboardButton(f"Acknowledge: {summary}", callback_data=f"ack_{format_event_id(event_id)}")])
+        message = "\n".join(lines)
+
+    return message, InlineKeyboardMarkup(keyboard)
+
+async def _send_reminders(bot, user_id: int, due: list[tuple[int, Reminder, datetime]]) -> None:
+    """Send the due reminders of a user as a single message, with one acknowledge button per event."""
+    message, reply_markup = _build_reminder_message(due)
+    await bot.send_message(
+        chat_id=user_id,
+        text=message,
+        reply_markup=reply_markup
+    )
 
-                event_id = _make_event_id(user_id, component, start_time, summary)
+async def sweep_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send all due reminders and schedule their next repetition.
+
+    This single repeating job drives every reminder, so the job queue does not
+    grow with the number of events. The due reminders of a user are sent as one
+    message.
+    """
+    interval = timedelta(hours=reminder_interval_hours)
+    now_naive = datetime.now()
+    now_utc = datetime.now(timezone.utc)
+
+    # Iterate over snapshots, handlers may change the reminders while we await sends
+    for user_id, user_map in list(user_reminders.items()):
+        due: list[tuple[int, Reminder, datetime]] = []
+        for event_id, event_data in list(user_map.items()):
+            if event_data.acknowledged:
+                continue
 
-                # Schedule the first reminder (day before at configured time)
-                reminder_time = start_time.replace(hour=reminder_hour, minute=reminder_minute, second=0, microsecond=0) - timedelta(days=1)
-                next_reminder_time = reminder_time if reminder_time > now else now + timedelta(seconds=5)
+            event_start = event_data.start_time
+            now = now_utc.astimezone(event_start.tzinfo) if event_start.tzinfo else now_naive
 
-                new_reminders[event_id] = {
-                    'summary': summary,
-                    'event_type': event_type,
-                    'start_time': start_time,
-                    'acknowledged': False,
-                    'job': None,
-                    'next_reminder_time': next_reminder_time,
-                    'first_reminder': next_reminder_time.date() < start_time.date(),
-                }
-                events_count += 1
+            if now >= event_data.cutoff:
+                user_map.pop(event_id, None)
+                dirty_reminders.add((user_id, event_id))
+                continue
 
-        # Replace existing reminders only after successfully parsing the calendar
-        logger.info(f"Replacing {len(user_reminders[user_id])} existing reminders for user {user_id} with {events_count} reminders from uploaded calendar")
-        for event_id, event_data in user_reminders[user_id].items():
-            _safe_schedule_removal(event_data.get("job"), user_id=user_id, event_id=event_id)
+            next_reminder_time = event_data.next_reminder_time
+            if next_reminder_time is not None and next_reminder_time > now:
+                continue
 
-        user_reminders[user_id] = new_reminders
+            due.append((event_id, event_data, now))
 
-        # Schedule reminder jobs
-        for event_id, event_data in user_reminders[user_id].items():
-            event_start = event_data["start_time"]
-            now = _now_like(event_start)
-            next_time = event_data.get("next_reminder_time")
-            if not isinstance(next_time, datetime) or next_time <= now:
-                next_time = now + timedelta(seconds=5)
-                event_data["next_reminder_time"] = next_time
-
-            delay = (next_time - now).total_seconds()
-            job = context.job_queue.run_once(
-                send_reminder,
-                delay,
-                data={'user_id': user_id, 'event_id': event_id},
-                name=f"reminder_{event_id}"
-            )
-            event_data["job"] = job
-
-        # Save reminders to disk - contains only non-expired, non-ignored events
-        save_user_reminders(data_path, user_id, user_reminders[user_id])
-        
-        await update.message.reply_text(f"Calendar processed successfully! Set up {events_count} reminders.")
+        # Schedule the next reminder before sending. The sweep started after an upload
+        # can overlap with the repeating one, which must not see these as due again.
+        for event_id, event_data, now in due:
+            cutoff = event_data.cutoff
+            next_reminder_time = now + interval
 
-    except Exception as e:
-        logger.exception("Error processing ICS file")
-        await update.message.reply_text(f"Error processing your calendar file: {str(e)}")
+            if next_reminder_time < cutoff:
+                event_data.next_reminder_time = next_reminder_time
+            else:
+                # Keep a sentinel time so no extra reminders are sent before expiry.
+                event_data.next_reminder_time = cutoff
 
-    finally:
-        # Clean up the file
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a reminder to the user."""
-    job = context.job
-    user_id = job.data['user_id']
-    event_id = job.data['event_id']
-
-    # Check if the event exists and is not acknowledged
-    if (user_id in user_reminders and
-            event_id in user_reminders[user_id] and
-            not user_reminders[user_id][event_id]['acknowledged']):
-
-        event_data = user_reminders[user_id][event_id]
-        event_summary = event_data['summary']
-        event_start = event_data['start_time']
-        now = _now_like(event_start)
-
-        if _is_event_expired(event_start, now):
-            user_reminders[user_id].pop(event_id, None)
-            save_user_reminders(data_path, user_id, user_reminders[user_id])
-            return
+            # Saved by the next flush
+            dirty_reminders.add((user_id, event_id))
 
-        event_date_str = event_start.strftime('%Y-%m-%d')
+        # Sort by start time so the most pressing events come first
+        due.sort(key=lambda item: _start_time_sort_key(item[1]))
+        for i in range(0, len(due), _MAX_REMINDERS_PER_MESSAGE):
+            batch = due[i:i + _MAX_REMINDERS_PER_MESSAGE]
+            try:
+                await _send_reminders(context.bot, user_id, batch)
+            except Exception:
+                logger.exception(f"Error sending {len(batch)} reminders (user={user_id})")
 
-        # Create the acknowledge button
-        keyboard = [[InlineKeyboardButton("Acknowledge", callback_data=f"ack_{event_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+async def _flush_dirty_reminders() -> None:
+    if not dirty_reminders:
+        return
 
-        days_until = (event_start.date() - now.date()).days
-        if days_until == 1:
-            message = f"⚠️ REMINDER: You have '{event_summary}' scheduled for tomorrow ({event_date_str})."
-        elif days_until == 0:
-            message = f"⚠️ REMINDER: Don't forget about '{event_summary}' scheduled for today ({event_date_str})."
+    upserts = []
+    deletions = []
+    for user_id, event_id in dirty_reminders:
+        event_data = user_reminders.get(user_id, {}).get(event_id)
+        if event_data is None:
+            deletions.append((user_id, event_id))
         else:
-            message = f"⚠️ REMINDER: Don't forget about '{event_summary}' coming up on {event_date_str}."
+            upserts.append((user_id, event_id, event_data))
 
-        # Send the reminder
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=message,
-            reply_markup=reply_markup
-        )
+    dirty_reminders.clear()
+    await _run_db(update_reminders, data_path, upserts, deletions)
 
-        # Schedule the next reminder if needed
-        cutoff = _event_cutoff(event_start)
-        next_reminder_time = now + timedelta(hours=reminder_interval_hours)
-
-        if next_reminder_time < cutoff:
-            next_job = context.job_queue.run_once(
-                send_reminder,
-                reminder_interval_hours * 3600,  # Convert hours to seconds
-                data={'user_id': user_id, 'event_id': event_id},
-                name=f"reminder_{event_id}"
-            )
-            user_reminders[user_id][event_id]['job'] = next_job
-            user_reminders[user_id][event_id]['next_reminder_time'] = next_reminder_time
-            user_reminders[user_id][event_id]['first_reminder'] = next_reminder_time.date() < event_start.date()
-            
-            # Save updated reminder info
-            save_user_reminders(data_path, user_id, user_reminders[user_id])
-        else:
-            user_reminders[user_id][event_id]['job'] = None
-            # Keep a sentinel time so restarts don't schedule extra reminders before expiry.
-            user_reminders[user_id][event_id]['next_reminder_time'] = cutoff
-            user_reminders[user_id][event_id]['first_reminder'] = False
-            save_user_reminders(data_path, user_id, user_reminders[user_id])
+async def flush_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Save the reminders that changed since the last flush."""
+    await _flush_dirty_reminders()
 
 @whitelist_only
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -441,89 +648,102 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Extract the event_id from the callback data
     if query.data.startswith("ack_"):
-        event_id = query.data[4:]
+        try:
+            event_id = parse_event_id(query.data[4:])
+        except ValueError:
+            logger.warning(f"Ignoring invalid callback data: {query.data}")
+            return
         user_id = update.effective_user.id
 
-        if user_id in user_reminders and event_id in user_reminders[user_id]:
-            event_summary = user_reminders[user_id][event_id]['summary']
-
-            # Cancel any scheduled jobs for this event, then remove it from the reminder list
-            _safe_schedule_removal(user_reminders[user_id][event_id].get("job"), user_id=user_id, event_id=event_id)
-            user_reminders[user_id].pop(event_id, None)
-            save_user_reminders(data_path, user_id, user_reminders[user_id])
+        # Remove it from the reminder list, the sweep only looks at listed events
+        user_map = user_reminders.get(user_id)
+        event_data = user_map.pop(event_id, None) if user_map else None
+        if event_data is None:
+            return
 
+        await _run_db(update_reminders, data_path, deletions=[(user_id, event_id)])
+
+        # A message for several events is rebuilt for the others that are still active
+        message = query.message
+        reply_markup = message.reply_markup if message else None
+        now_naive = datetime.now()
+        now_utc = datetime.now(timezone.utc)
+        remaining = []
+        for row in (reply_markup.inline_keyboard if reply_markup else ()):
+            callback_data = row[0].callback_data
+            if callback_data == query.data or not callback_data.startswith("ack_"):
+                continue
+            try:
+                other_id = parse_event_id(callback_data[4:])
+            except ValueError:
+                continue
+            other = user_map.get(other_id)
+            if other is None:
+                continue
+            event_start = other.start_time
+            now = now_utc.astimezone(event_start.tzinfo) if event_start.tzinfo else now_naive
+            remaining.append((other_id, other, now))
+        if remaining:
+            text, remaining_markup = _build_reminder_message(remaining)
             await query.edit_message_text(
-                f"✅ Acknowledged: '{event_summary}'. No more reminders will be sent for this event.")
+                f"✅ Acknowledged: '{_shorten(event_data.summary, _MAX_BATCH_SUMMARY)}'\n\n{text}",
+                reply_markup=remaining_markup)
+            return
+
+        await query.edit_message_text(
+            f"✅ Acknowledged: '{_shorten(event_data.summary, _MAX_SUMMARY)}'. No more reminders will be sent for this event.")
+
+async def restore_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Restore reminders from saved data when the bot starts."""
+    # Events dated before today are expired in any timezone, drop them before they
+    # are loaded at all. Events from yesterday or today are checked below.
+    now_naive = datetime.now()
+    now_utc = datetime.now(timezone.utc)
+    expired_events_removed = await _run_db(delete_reminders_before, data_path, now_naive.date())
 
-async def restore_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Restore jobs from saved data when the bot starts."""
-    user_ids = load_all_users(data_path)
+    user_ids = await _run_db(load_all_users, data_path)
     
-    jobs_restored = 0
-    expired_events_removed = 0
+    reminders_restored = 0
+    changed_users: set[int] = set()
     
     for user_id in user_ids:
-        loaded_reminders = load_user_reminders(data_path, user_id)
-        user_reminders[user_id] = {}  # Start with empty dict to ensure we only store valid events
+        loaded_reminders = await _run_db(load_user_reminders, data_path, user_id)
+        user_map = user_reminders[user_id] = {}  # Start with empty dict to ensure we only store valid events
         user_changed = False
         
         for event_id, event_data in loaded_reminders.items():
             # Skip acknowledged events and expired events
-            if event_data.get('acknowledged', False):
+            if event_data.acknowledged:
                 user_changed = True
                 continue
                 
-            event_start = event_data.get('start_time')
-            if not isinstance(event_start, datetime):
-                user_changed = True
-                continue
+            event_start = event_data.start_time
 
-            now = _now_like(event_start)
-            if _is_event_expired(event_start, now):
+            now = now_utc.astimezone(event_start.tzinfo) if event_start.tzinfo else now_naive
+            if now >= event_data.cutoff:
                 expired_events_removed += 1
                 user_changed = True
                 continue
                 
             # Add this valid event to the user's reminders
-            user_reminders[user_id][event_id] = event_data
-            if "event_type" not in user_reminders[user_id][event_id]:
-                user_reminders[user_id][event_id]["event_type"] = user_reminders[user_id][event_id].get("summary") or "Unknown"
-                user_changed = True
-                
-            # Determine next reminder time
-            next_reminder_time = event_data.get('next_reminder_time')
-            
-            # If no next_reminder_time or it's in the past, calculate a new one
-            if not isinstance(next_reminder_time, datetime) or next_reminder_time <= now:
-                day_before = event_start.replace(hour=reminder_hour, minute=reminder_minute, second=0, microsecond=0) - timedelta(days=1)
-                next_reminder_time = day_before if day_before > now else now + timedelta(seconds=5)
-                user_changed = True
-            
-            # Schedule the job if we have a valid next_reminder_time
-            cutoff = _event_cutoff(event_start)
-            if isinstance(next_reminder_time, datetime) and next_reminder_time > now and next_reminder_time < cutoff:
-                delay = (next_reminder_time - now).total_seconds()
-                job = context.job_queue.run_once(
-                    send_reminder,
-                    delay,
-                    data={'user_id': user_id, 'event_id': event_id},
-                    name=f"reminder_{event_id}"
-                )
-                user_reminders[user_id][event_id]['job'] = job
-                user_reminders[user_id][event_id]['next_reminder_time'] = next_reminder_time
-                user_reminders[user_id][event_id]['first_reminder'] = next_reminder_time.date() < event_start.date()
-                jobs_restored += 1
-            else:
-                user_reminders[user_id][event_id]['job'] = None
-                user_reminders[user_id][event_id]['next_reminder_time'] = cutoff
-                user_reminders[user_id][event_id]['first_reminder'] = False
+            user_map[event_id] = event_data
+
+            # Reminders saved without a schedule start with the day-before reminder.
+            # Overdue reminders are picked up by the next sweep.
+            if event_data.next_reminder_time is None:
+                day_before = _day_before_reminder(event_start)
+                event_data.next_reminder_time = day_before if day_before > now else now
                 user_changed = True
+
+            reminders_restored += 1
         
-        # Save back the filtered reminders
         if user_changed:
-            save_user_reminders(data_path, user_id, user_reminders[user_id])
+            changed_users.add(user_id)
     
-    logger.info(f"Restored {jobs_restored} reminder jobs for {len(user_ids)} users")
+    # Save back the filtered reminders of all changed users at once
+    await _run_db(save_all_reminders, data_path, {user_id: dict(user_reminders[user_id]) for user_id in changed_users})
+
+    logger.info(f"Restored {reminders_restored} reminders for {len(user_ids)} users")
     if expired_events_removed > 0:
         logger.info(f"Removed {expired_events_removed} expired events during startup")
 
@@ -538,6 +758,13 @@ async def setup_bot_commands(context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.set_my_commands(commands)
     logger.info("Bot commands registered.")
 
+async def close_database(application: Application) -> None:
+    """Flush pending changes and close the reminder database when the bot shuts down."""
+    await _flush_dirty_reminders()
+    await _run_db(close_connection, data_path)
+    db_executor.shutdown()
+    logger.info("Reminder database closed.")
+
 def main() -> None:
     """Start the bot."""
     ensure_data_directory(data_path)
@@ -546,7 +773,7 @@ def main() -> None:
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     
     # Create the Application
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(close_database).build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -559,19 +786,24 @@ def main() -> None:
     application.add_handler(MessageHandler(ics_filter, handle_ics_file))
     application.add_handler(CallbackQueryHandler(button_callback))
     
-    # Set up jobs restoration and bot commands when the bot starts
-    application.job_queue.run_once(restore_jobs, 1)
+    # Restore reminders and register bot commands when the bot starts,
+    # then check for due reminders periodically
+    application.job_queue.run_once(restore_reminders, 1)
     application.job_queue.run_once(setup_bot_commands, 2)
+    application.job_queue.run_repeating(sweep_reminders, interval=sweep_interval, first=5)
+    application.job_queue.run_repeating(flush_reminders, interval=flush_interval)
 
-    # Run the bot
-    while True:
-        try:
-            logger.info("Starting the bot...")
-            application.run_polling()
-        except Exception:
-            logger.exception("Bot crashed with error")
-            logger.info("Attempting restart in 20 seconds...")
-            sleep(20)
+    # Record our PID for the container healthcheck, the bot itself does not need it
+    try:
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+    except OSError as e:
+        logger.warning(f"Could not write PID file {pid_file}: {e}")
+
+    # Run the bot. Network errors are retried by python-telegram-bot itself;
+    # anything fatal ends the process so Docker's restart policy takes over.
+    logger.info("Starting the bot...")
+    application.run_polling()
 
 
 if __name__ == '__main__':
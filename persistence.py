@@ -1,104 +1,282 @@
 import os
 import json
+import hashlib
 import logging
-from datetime import datetime
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime, time
 
 logger = logging.getLogger(__name__)
 
+# Open database connections, keyed by data path
+_connections = {}
+
+# Columns written for each reminder. Databases created by older versions also
+# have a first_reminder column, which is no longer used and left NULL.
+_REMINDER_COLUMNS = "user_id, event_id, summary, event_type, start_time, acknowledged, next_reminder_time"
+
+@dataclass(slots=True)
+class Reminder:
+    """A reminder for a single calendar event."""
+    summary: str
+    start_time: datetime
+    event_type: str
+    acknowledged: bool = False
+    next_reminder_time: datetime | None = None
+    # Reminder window ends at the day rollover into the event day (00:00).
+    # Derived from start_time, so it is neither stored nor compared.
+    cutoff: datetime = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.cutoff = datetime.combine(self.start_time.date(), time.min, tzinfo=self.start_time.tzinfo)
+
+def format_event_id(event_id):
+    """Format an event ID as the fixed-width hex string used in the database and callback data."""
+    return f"{event_id:016x}"
+
+def parse_event_id(text):
+    """Parse an event ID from its hex form.
+
+    Older versions prefixed the hex digest with the user ID ("<user_id>_<hex>"),
+    which is accepted as well.
+    """
+    user_prefix, _, digest = text.rpartition('_')
+    if user_prefix and not user_prefix.lstrip('-').isdigit():
+        raise ValueError(f"invalid event ID: {text!r}")
+    return int(digest, 16)
+
+def _legacy_event_id(text):
+    """Convert an event ID written by an older version, hashing IDs that are not hex."""
+    try:
+        return parse_event_id(text)
+    except ValueError:
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8", errors="ignore"), digest_size=8).digest(), "big")
+
 def ensure_data_directory(data_path):
     """Ensure the data directory exists."""
     os.makedirs(data_path, exist_ok=True)
 
-def get_user_data_path(data_path, user_id):
-    """Get the path for a specific user's data file."""
+def get_connection(data_path):
+    """Get the SQLite connection for the data directory, opening it on first use."""
+    conn = _connections.get(data_path)
+    if conn is not None:
+        return conn
+
+    ensure_data_directory(data_path)
+    # The bot runs all database calls on one worker thread, which need not be the one that opened it
+    conn = sqlite3.connect(os.path.join(data_path, 'reminders.db'), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS reminders ("
+        " user_id INTEGER NOT NULL,"
+        " event_id TEXT NOT NULL,"
+        " summary TEXT NOT NULL,"
+        " event_type TEXT,"
+        " start_time TEXT NOT NULL,"
+        " acknowledged INTEGER NOT NULL DEFAULT 0,"
+        " next_reminder_time TEXT,"
+        " PRIMARY KEY (user_id, event_id))"
+    )
+    # Convert event IDs written by older versions, which contain the user ID prefix
+    legacy_ids = [event_id for (event_id,) in conn.execute(
+        "SELECT DISTINCT event_id FROM reminders WHERE instr(event_id, '_') > 0"
+    )]
+    conn.executemany(
+        "UPDATE OR REPLACE reminders SET event_id = ? WHERE event_id = ?",
+        [(format_event_id(_legacy_event_id(event_id)), event_id) for event_id in legacy_ids],
+    )
+    conn.commit()
+    _connections[data_path] = conn
+
+    migrate_json_reminders(data_path, conn)
+    return conn
+
+def close_connection(data_path):
+    """Optimize and close the SQLite connection for the data directory."""
+    conn = _connections.pop(data_path, None)
+    if conn is None:
+        return
+    try:
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+
+def migrate_json_reminders(data_path, conn):
+    """Import reminders from the legacy per-user JSON files into the database."""
     user_dir = os.path.join(data_path, 'users')
-    os.makedirs(user_dir, exist_ok=True)
-    return os.path.join(user_dir, f"user_{user_id}.json")
+    if not os.path.isdir(user_dir):
+        return
+
+    with os.scandir(user_dir) as entries:
+        filenames = [
+            entry.name for entry in entries
+            if entry.name.startswith("user_") and entry.name.endswith(".json") and entry.is_file()
+        ]
+
+    for filename in filenames:
+        try:
+            user_id = int(filename[5:-5])  # Extract user_id from "user_XXXXX.json"
+        except ValueError:
+            continue
+
+        file_path = os.path.join(user_dir, filename)
+        try:
+            with open(file_path, 'r') as f:
+                serialized_reminders = json.load(f)
+
+            # A broken reminder must not keep the rest of the file from being imported
+            rows = []
+            for event_id, event_data in serialized_reminders.items():
+                try:
+                    rows.append((
+                        user_id,
+                        format_event_id(_legacy_event_id(event_id)),
+                        event_data['summary'],
+                        event_data.get('event_type') or event_data['summary'],
+                        event_data['start_time'],
+                        int(event_data['acknowledged']),
+                        event_data.get('next_reminder_time') or None,
+                    ))
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping invalid reminder {event_id} of user {user_id} in {filename}: {e}")
+
+            with conn:
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO reminders ({_REMINDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            # Keep the old file around, but make sure it is not imported again
+            os.replace(file_path, file_path + ".migrated")
+            logger.info(f"Migrated {len(rows)} reminders for user {user_id} from {filename}")
+        except Exception as e:
+            logger.error(f"Error migrating reminders for user {user_id}: {e}")
+
+def _reminder_row(user_id, event_id, reminder):
+    """Convert a single reminder to a database row."""
+    next_reminder = reminder.next_reminder_time
+    return (
+        user_id,
+        format_event_id(event_id),
+        reminder.summary,
+        reminder.event_type or reminder.summary,
+        reminder.start_time.isoformat(),
+        int(reminder.acknowledged),
+        next_reminder.isoformat() if next_reminder else None,
+    )
+
+def _replace_reminders(data_path, reminders_by_user):
+    """Replace the stored reminders of the given users in a single transaction."""
+    conn = get_connection(data_path)
+    with conn:
+        conn.executemany("DELETE FROM reminders WHERE user_id = ?", [(user_id,) for user_id in reminders_by_user])
+        conn.executemany(
+            f"INSERT INTO reminders ({_REMINDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                _reminder_row(user_id, event_id, reminder)
+                for user_id, reminders in reminders_by_user.items()
+                for event_id, reminder in reminders.items()
+            ),
+        )
 
 def save_user_reminders(data_path, user_id, reminders):
     """Save user reminders to disk."""
-    file_path = get_user_data_path(data_path, user_id)
-    
-    # Convert data to serializable format
-    serializable_reminders = {}
-    for event_id, event_data in reminders.items():
-        reminder_data = {
-            'summary': event_data['summary'],
-            'event_type': event_data.get('event_type') or event_data['summary'],
-            'start_time': event_data['start_time'].isoformat(),
-            'acknowledged': event_data['acknowledged'],
-            'first_reminder': event_data.get('first_reminder', True)
-        }
-        
-        # Handle next_reminder_time if it exists and is a datetime
-        next_reminder = event_data.get('next_reminder_time')
-        if next_reminder:
-            if isinstance(next_reminder, datetime):
-                reminder_data['next_reminder_time'] = next_reminder.isoformat()
-            else:
-                reminder_data['next_reminder_time'] = next_reminder
-        else:
-            reminder_data['next_reminder_time'] = ''
-            
-        serializable_reminders[event_id] = reminder_data
-    
     try:
-        with open(file_path, 'w') as f:
-            json.dump(serializable_reminders, f, indent=2)
-        logger.info(f"Saved {len(serializable_reminders)} reminders for user {user_id}")
+        _replace_reminders(data_path, {user_id: reminders})
+        logger.info(f"Saved {len(reminders)} reminders for user {user_id}")
         return True
     except Exception as e:
         logger.error(f"Error saving reminders for user {user_id}: {e}")
         return False
 
+def save_all_reminders(data_path, reminders_by_user):
+    """Save the reminders of several users to disk in a single transaction."""
+    if not reminders_by_user:
+        return True
+    try:
+        _replace_reminders(data_path, reminders_by_user)
+        logger.info(f"Saved reminders for {len(reminders_by_user)} users")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving reminders for users {sorted(reminders_by_user)}: {e}")
+        return False
+
+def update_reminders(data_path, upserts=(), deletions=()):
+    """Write and delete individual reminders in a single transaction.
+
+    upserts holds (user_id, event_id, reminder) tuples, deletions (user_id, event_id) tuples.
+    """
+    upserts = list(upserts)
+    deletions = list(deletions)
+    if not upserts and not deletions:
+        return True
+    try:
+        conn = get_connection(data_path)
+        with conn:
+            conn.executemany(
+                "DELETE FROM reminders WHERE user_id = ? AND event_id = ?",
+                [(user_id, format_event_id(event_id)) for user_id, event_id in deletions],
+            )
+            conn.executemany(
+                f"INSERT OR REPLACE INTO reminders ({_REMINDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [_reminder_row(user_id, event_id, reminder) for user_id, event_id, reminder in upserts],
+            )
+        logger.info(f"Saved {len(upserts)} and deleted {len(deletions)} reminders")
+        return True
+    except Exception as e:
+        logger.error(f"Error updating reminders: {e}")
+        return False
+
+def delete_reminders_before(data_path, before_date):
+    """Delete reminders of events dated before before_date, without loading them.
+
+    start_time is stored in ISO 8601, so a plain string comparison against the
+    date prefix finds them. Returns the number of deleted reminders.
+    """
+    try:
+        conn = get_connection(data_path)
+        with conn:
+            cursor = conn.execute("DELETE FROM reminders WHERE start_time < ?", (before_date.isoformat(),))
+        return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Error deleting reminders before {before_date}: {e}")
+        return 0
+
 def load_user_reminders(data_path, user_id):
     """Load user reminders from disk."""
-    file_path = get_user_data_path(data_path, user_id)
-    
-    if not os.path.exists(file_path):
-        logger.info(f"No saved reminders found for user {user_id}")
-        return {}
-    
     try:
-        with open(file_path, 'r') as f:
-            serialized_reminders = json.load(f)
-        
-        # Convert back to usable format
+        conn = get_connection(data_path)
+        rows = conn.execute(
+            "SELECT event_id, summary, event_type, start_time, acknowledged, next_reminder_time"
+            " FROM reminders WHERE user_id = ?",
+            (user_id,),
+        ).fetchall()
+
+        # Convert back to usable format, callers rely on the times being datetimes
         reminders = {}
-        for event_id, event_data in serialized_reminders.items():
-            reminders[event_id] = {
-                'summary': event_data['summary'],
-                'event_type': event_data.get('event_type') or event_data['summary'],
-                'start_time': datetime.fromisoformat(event_data['start_time']),
-                'acknowledged': event_data['acknowledged'],
-                'job': None
-            }
-            
-            if 'next_reminder_time' in event_data and event_data['next_reminder_time']:
-                reminders[event_id]['next_reminder_time'] = datetime.fromisoformat(event_data['next_reminder_time'])
-            
-            if 'first_reminder' in event_data:
-                reminders[event_id]['first_reminder'] = event_data['first_reminder']
-                
-        logger.info(f"Loaded {len(reminders)} reminders for user {user_id}")
+        for event_id, summary, event_type, start_time, acknowledged, next_reminder_time in rows:
+            try:
+                reminders[parse_event_id(event_id)] = Reminder(
+                    summary=summary,
+                    start_time=datetime.fromisoformat(start_time),
+                    event_type=event_type or summary,
+                    acknowledged=bool(acknowledged),
+                    next_reminder_time=datetime.fromisoformat(next_reminder_time) if next_reminder_time else None,
+                )
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Skipping invalid reminder {event_id} of user {user_id}: {e}")
+
+        if not reminders:
+            logger.info(f"No saved reminders found for user {user_id}")
+        else:
+            logger.info(f"Loaded {len(reminders)} reminders for user {user_id}")
         return reminders
     except Exception as e:
         logger.error(f"Error loading reminders for user {user_id}: {e}")
         return {}
 
 def load_all_users(data_path):
-    """Load all user IDs from the data directory."""
-    user_dir = os.path.join(data_path, 'users')
-    if not os.path.exists(user_dir):
-        return []
-    
-    user_ids = []
-    for filename in os.listdir(user_dir):
-        if filename.startswith("user_") and filename.endswith(".json"):
-            try:
-                user_id = int(filename[5:-5])  # Extract user_id from "user_XXXXX.json"
-                user_ids.append(user_id)
-            except ValueError:
-                continue
-    
-    return user_ids
+    """Load all user IDs that have saved reminders."""
+    conn = get_connection(data_path)
+    return [user_id for (user_id,) in conn.execute("SELECT DISTINCT user_id FROM reminders")]